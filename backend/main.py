@@ -6,6 +6,7 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
 from routers import prompts, datasets, evaluations, improvements, stats
 from db.supabase_client import supabase
+from services.llm_client import close_client
 from typing import Optional
 from dependencies import get_current_user
 import logging
@@ -49,6 +50,11 @@ async def log_requests_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# Close the pooled LLM HTTP client on shutdown
+@app.on_event("shutdown")
+async def shutdown_llm_client():
+    await close_client()
+
 # Health check (unprotected)
 @app.get("/health")
 async def health_check():
@@ -175,7 +175,6 @@ async def add_dataset_rows(
         if isinstance(row, dict) and "input" in row:
             # Row is already structured: {input: ..., expected_output: ..., metadata: ...}
             sample = {
-                "dataset_id": str(dataset_id),
                 "input": row["input"],
                 "expected_output": row.get("expected_output"),
                 "metadata": row.get("metadata", {})
@@ -183,7 +182,6 @@ async def add_dataset_rows(
         else:
             # Row is a flat dict or other type
             sample = {
-                "dataset_id": str(dataset_id),
                 "input": row,
                 "expected_output": row.get("expected_output") if isinstance(row, dict) else None,
                 "metadata": {}
@@ -191,9 +189,15 @@ async def add_dataset_rows(
         samples_to_insert.append(sample)
     
     if samples_to_insert:
-        response = supabase.table("dataset_samples").insert(samples_to_insert).execute()
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to insert rows")
+        # Bulk insert via the insert_samples RPC like the service-layer
+        # paths; dataset_id travels once and nothing is echoed back
+        try:
+            supabase.rpc("insert_samples", {
+                "p_dataset_id": str(dataset_id),
+                "p_samples": samples_to_insert
+            }).execute()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to insert rows: {str(e)}")
     
     return {"message": f"{len(samples_to_insert)} rows added"}
 
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 from typing import List, Dict, Any, Tuple
@@ -126,7 +127,8 @@ Respond in JSON format as a list of objects, each with 'content' and 'rationale'
         data = json.loads(response)
         candidates = data if isinstance(data, list) else data.get("candidates", [])
         return [(c["content"], c["rationale"]) for c in candidates[:num_candidates]]
-    except:
+    except Exception as e:
+        print(f"CoT candidate generation failed: {str(e)}")
         return []
 
 async def generate_few_shot_candidates(
@@ -138,21 +140,17 @@ async def generate_few_shot_candidates(
     """Generate candidates by adding Few-Shot examples"""
     if not dataset_samples:
         return []
-        
-    candidates = []
-    
-    # Try different combinations of examples
-    for i in range(num_candidates):
-        try:
-            # Select 3 random examples
-            k = min(len(dataset_samples), 3)
-            selected_samples = random.sample(dataset_samples, k)
-            
-            examples_context = ""
-            for j, sample in enumerate(selected_samples):
-                examples_context += f"Example {j+1}:\nInput: {json.dumps(sample['input'])}\nOutput: {json.dumps(sample['expected_output'])}\n\n"
-            
-            meta_prompt = f"""You are an expert Prompt Engineer. Rewrite the prompt to include the provided few-shot examples effectively. 
+
+    async def generate_one() -> Tuple[str, str]:
+        # Select 3 random examples
+        k = min(len(dataset_samples), 3)
+        selected_samples = random.sample(dataset_samples, k)
+
+        examples_context = ""
+        for j, sample in enumerate(selected_samples):
+            examples_context += f"Example {j+1}:\nInput: {json.dumps(sample['input'])}\nOutput: {json.dumps(sample['expected_output'])}\n\n"
+
+        meta_prompt = f"""You are an expert Prompt Engineer. Rewrite the prompt to include the provided few-shot examples effectively. 
 The goal is to improve performance on the task by showing the model exactly what is expected.
 
 Current Prompt:
@@ -165,21 +163,32 @@ Examples to add:
 
 Return a JSON object with 'content' (the new full prompt) and 'rationale' (why these examples were chosen or how they are integrated).
 """
-            response = await call_llm(
-                [{"role": "user", "content": meta_prompt}],
-                temperature=0.7,
-                response_format={"type": "json_object"}
-            )
-            data = json.loads(response)
-            
-            # Handle potentially different formats
-            if isinstance(data, dict):
-                 candidates.append((data.get("content", ""), data.get("rationale", "Added few-shot examples")))
-            elif isinstance(data, list) and len(data) > 0:
-                 candidates.append((data[0].get("content", ""), data[0].get("rationale", "Added few-shot examples")))
-                 
-        except Exception as e:
-            print(f"Few-shot generation failed: {e}")
+        response = await call_llm(
+            [{"role": "user", "content": meta_prompt}],
+            temperature=0.7,
+            response_format={"type": "json_object"}
+        )
+        data = json.loads(response)
+
+        # Handle potentially different formats
+        if isinstance(data, dict):
+            return (data.get("content", ""), data.get("rationale", "Added few-shot examples"))
+        elif isinstance(data, list) and len(data) > 0:
+            return (data[0].get("content", ""), data[0].get("rationale", "Added few-shot examples"))
+        raise ValueError("No candidate in response")
+
+    # Each candidate uses a different random example draw, so these are
+    # distinct prompts - run them concurrently rather than serially
+    results = await asyncio.gather(
+        *[generate_one() for _ in range(num_candidates)],
+        return_exceptions=True
+    )
+
+    candidates = []
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Few-shot generation failed: {result}")
             continue
-            
+        candidates.append(result)
+
     return candidates
@@ -1,12 +1,138 @@
 from typing import Dict, Any, List, Optional
 from uuid import UUID
 from db.supabase_client import supabase
-from services.evaluation import run_full_evaluation
+from services.evaluation import run_full_evaluation, prepare_evaluation_context
 from services.candidate_generator import generate_candidates
 from services.llm_client import call_llm
 from models.schemas import Evaluation
+import asyncio
 import datetime
 import json
+import os
+import numpy as np
+import tiktoken
+
+# orjson serializes compact JSON several times faster than stdlib; the
+# explanation prompt and Supabase payloads are built per loop run
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+# Early-stopping knobs for candidate evaluation. Chunked evaluation
+# lets clearly-losing candidates be dropped before burning LLM calls on
+# the full dataset; tau is the leader's average-score margin over the
+# rest that ends the race early.
+EVAL_CHUNK_SIZE = int(os.getenv("CANDIDATE_EVAL_CHUNK_SIZE", "8"))
+EARLY_STOP_TAU = float(os.getenv("CANDIDATE_EARLY_STOP_TAU", "0.05"))
+PRUNE_MARGIN = 0.05
+
+# Static scaffolding of the explanation prompt, rendered once at import.
+# Deltas alone carry the signal; dumping baseline and candidate score
+# tables as well roughly tripled the input tokens for no extra insight.
+_EXPLANATION_TEMPLATE = """You are explaining a prompt optimization decision to a prompt engineer.
+
+**Decision**: {decision}
+{reason_line}**Baseline Prompt**:
+{baseline_content}
+
+**Candidate Prompt**:
+{candidate_content}
+
+**Metric Deltas** (candidate minus baseline):
+{metric_deltas}
+{example_context}
+Provide a clear, concise explanation (2-3 sentences) of:
+1. What changed in the prompt
+2. Why the decision was made based on the metrics
+3. Key insights about the improvement or failure
+
+Respond in plain text, no JSON."""
+
+
+# Tokenizer for prompt truncation; guarded like the evaluation service
+# since tiktoken downloads its ranks file on first use
+try:
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+
+def _smart_trunc(s: str, head: int = 200, tail: int = 100) -> str:
+    """Token-budgeted truncation that keeps the head and tail.
+
+    Prompts under budget pass through untouched - a blind [:500] slice
+    charged for 500 chars even on short prompts and could cut
+    mid-sentence, leaving the model to repair the context. Falls back
+    to a character budget when tiktoken is unavailable.
+    """
+    if _ENCODING is None:
+        limit = (head + tail) * 4
+        if len(s) <= limit:
+            return s
+        return s[:head * 4] + " ...[truncated]... " + s[-tail * 4:]
+    tokens = _ENCODING.encode(s)
+    if len(tokens) <= head + tail:
+        return s
+    return _ENCODING.decode(tokens[:head]) + " ...[truncated]... " + _ENCODING.decode(tokens[-tail:])
+
+
+def _metric_deltas(baseline_scores: Dict[str, float], candidate_scores: Dict[str, float]) -> Dict[str, float]:
+    """Candidate-minus-baseline deltas computed as one vector subtraction"""
+    keys = tuple(baseline_scores)
+    b = np.fromiter((baseline_scores[k] for k in keys), dtype=np.float64, count=len(keys))
+    c = np.fromiter((candidate_scores.get(k, 0.0) for k in keys), dtype=np.float64, count=len(keys))
+    return dict(zip(keys, (c - b).tolist()))
+
+
+async def _db(fn):
+    """Run a blocking Supabase call in a worker thread.
+
+    The sync client would otherwise block the event loop and stall
+    concurrent LLM work while a write is in flight.
+    """
+    return await asyncio.to_thread(fn)
+
+
+# Strong references to in-flight fire-and-forget tasks; without them
+# the event loop may garbage-collect a task before it runs
+_BACKGROUND_TASKS: set = set()
+
+
+def _fire_and_forget(fn) -> None:
+    """Schedule a non-critical Supabase write without blocking the caller.
+
+    Failures are logged by the task itself; the response path doesn't
+    wait for (or depend on) these writes landing.
+    """
+    async def _run():
+        try:
+            await _db(fn)
+        except Exception as e:
+            print(f"Background write failed: {str(e)}")
+
+    task = asyncio.create_task(_run())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+def _format_rejection_explanation(rejection_reason: str, metric_deltas: Dict[str, float]) -> str:
+    """Synthesize a rejection explanation from the metrics directly.
+
+    Rejections come from deterministic numeric guardrails; spending an
+    LLM call to paraphrase them produced boilerplate.
+    """
+    if not metric_deltas:
+        return f"Rejected: {rejection_reason}."
+    worst_metric, worst_delta = min(metric_deltas.items(), key=lambda kv: kv[1])
+    if worst_delta < 0:
+        return f"Rejected: {rejection_reason}. Largest regression: {worst_metric} ({worst_delta:.1%})."
+    best_metric, best_delta = max(metric_deltas.items(), key=lambda kv: kv[1])
+    return f"Rejected: {rejection_reason}. Best gain was {best_metric} ({best_delta:+.1%})."
 
 
 async def generate_promotion_explanation(
@@ -20,52 +146,36 @@ async def generate_promotion_explanation(
 ) -> str:
     """Generate natural language explanation for promotion/rejection decision"""
     
-    metric_deltas = {k: candidate_scores[k] - baseline_scores[k] for k in baseline_scores}
-    
+    metric_deltas = _metric_deltas(baseline_scores, candidate_scores)
+
     # Format per-example context if available
     example_context = ""
     if per_example_deltas:
-        improved_count = sum(1 for ex in per_example_deltas if ex.get("delta", 0) > 0)
-        regressed_count = sum(1 for ex in per_example_deltas if ex.get("delta", 0) < 0)
+        deltas = np.fromiter(
+            (ex.get("delta", 0) for ex in per_example_deltas),
+            dtype=np.float64,
+            count=len(per_example_deltas)
+        )
+        improved_count = int((deltas > 0).sum())
+        regressed_count = int((deltas < 0).sum())
         example_context = f"\n\nPer-example analysis: {improved_count} samples improved, {regressed_count} regressed."
     
-    explanation_prompt = f"""You are explaining a prompt optimization decision to a prompt engineer.
-
-**Decision**: {"PROMOTED" if should_promote else "REJECTED"}
-{f"**Reason**: {rejection_reason}" if rejection_reason else ""}
-
-**Baseline Prompt**:
-```
-{baseline_content[:500]}...
-```
-
-**Candidate Prompt**:
-```
-{candidate_content[:500]}...
-```
-
-**Metric Changes** (candidate vs baseline):
-{json.dumps(metric_deltas, indent=2)}
-
-**Baseline Scores**:
-{json.dumps(baseline_scores, indent=2)}
-
-**Candidate Scores**:
-{json.dumps(candidate_scores, indent=2)}
-{example_context}
-
-Provide a clear, concise explanation (2-3 sentences) of:
-1. What changed in the prompt
-2. Why the decision was made based on the metrics
-3. Key insights about the improvement or failure
-
-Respond in plain text, no JSON."""
+    # Compact JSON with 3-decimal floats: pretty-printing the score
+    # dicts added ~30-40% input tokens purely in whitespace
+    explanation_prompt = _EXPLANATION_TEMPLATE.format(
+        decision="PROMOTED" if should_promote else "REJECTED",
+        reason_line=f"**Reason**: {rejection_reason}\n" if rejection_reason else "",
+        baseline_content=_smart_trunc(baseline_content),
+        candidate_content=_smart_trunc(candidate_content),
+        metric_deltas=_json_dumps({k: round(v, 3) for k, v in metric_deltas.items()}),
+        example_context=example_context
+    )
 
     try:
         explanation = await call_llm(
             [{"role": "user", "content": explanation_prompt}],
             temperature=0.3,
-            max_tokens=300
+            max_tokens=180
         )
         return explanation.strip()
     except Exception as e:
@@ -87,43 +197,52 @@ async def run_improvement_loop(
 ) -> Dict[str, Any]:
     """Run the full self-improvement loop with PRD guardrails"""
     
-    # 1. Get base prompt version to improve from
+    # 1-4. Fetch base version, prompt, dataset and samples concurrently.
+    # The Supabase client is synchronous, so each read is pushed to a
+    # thread and the four round-trips overlap instead of serializing.
     if base_version_id:
-        pv_resp = supabase.table("prompt_versions").select("*").eq("id", base_version_id).execute()
-        if not pv_resp.data:
-            raise ValueError(f"Prompt version {base_version_id} not found")
-        base_version = pv_resp.data[0]
+        pv_task = _db(
+            lambda: supabase.table("prompt_versions").select("*").eq("id", base_version_id).execute()
+        )
     else:
-        pv_resp = supabase.table("prompt_versions").select("*").eq("prompt_id", prompt_id).eq("is_active", True).execute()
-        if not pv_resp.data:
-            raise ValueError("No active version found for prompt")
-        base_version = pv_resp.data[0]
-    
-    
-    # 2. Get prompt details
-    p_resp = supabase.table("prompts").select("*").eq("id", prompt_id).execute()
+        pv_task = _db(
+            lambda: supabase.table("prompt_versions").select("*").eq("prompt_id", prompt_id).eq("is_active", True).execute()
+        )
+    p_task = _db(lambda: supabase.table("prompts").select("*").eq("id", prompt_id).execute())
+    d_task = _db(lambda: supabase.table("datasets").select("*").eq("id", dataset_id).execute())
+    s_task = _db(lambda: supabase.table("dataset_samples").select("*").eq("dataset_id", dataset_id).execute())
+
+    pv_resp, p_resp, d_resp, s_resp = await asyncio.gather(pv_task, p_task, d_task, s_task)
+
+    if not pv_resp.data:
+        if base_version_id:
+            raise ValueError(f"Prompt version {base_version_id} not found")
+        raise ValueError("No active version found for prompt")
+    base_version = pv_resp.data[0]
+
     if not p_resp.data:
         raise ValueError("Prompt not found")
     prompt = p_resp.data[0]
-    
-    # 3. Get dataset details
-    d_resp = supabase.table("datasets").select("*").eq("id", dataset_id).execute()
+
     if not d_resp.data:
         raise ValueError("Dataset not found")
     dataset = d_resp.data[0]
-    
+
     # Use dataset's default eval strategy if not overridden
     if not evaluation_strategy:
         evaluation_strategy = dataset.get("evaluation_strategy", "exact_match")
-    
+
     print(f"Using evaluation strategy: {evaluation_strategy}")
-    
-    # 4. Get dataset samples
-    s_resp = supabase.table("dataset_samples").select("*").eq("dataset_id", dataset_id).execute()
+
     if not s_resp.data:
         raise ValueError("Dataset has no samples")
     samples = s_resp.data
-    
+
+    # Precompute setup shared across runs (expected-output
+    # normalization, compiled schema validator) once; baseline and every
+    # candidate evaluation over these samples reuse it
+    prepare_evaluation_context(samples, prompt["output_schema"], evaluation_strategy)
+
     # 5. Baseline evaluation
     print(f"Running baseline evaluation for prompt {prompt_id}...")
     baseline_results = await run_full_evaluation(
@@ -148,63 +267,141 @@ async def run_improvement_loop(
         dataset_samples=samples
     )
     
-    # 7. Evaluate candidates and store them in DB
-    candidate_results = []
-    stored_candidates = []
-    
-    for content, rationale in candidates_data:
-        print(f"Evaluating candidate: {rationale[:50]}...")
-        eval_results = await run_full_evaluation(
+    # 7. Evaluate all candidates concurrently with adaptive early
+    # stopping: the dataset is consumed in chunks, and after each chunk
+    # (a) candidates whose best-case final average can no longer beat
+    # baseline + PRUNE_MARGIN are dropped, and (b) once the leader's
+    # average outruns the rest by EARLY_STOP_TAU the trailing candidates
+    # stop, leaving only the leader to finish the full dataset. Each
+    # chunk's evals run concurrently; call_llm's global semaphore keeps
+    # the combined fan-out under the rate limit.
+    print(f"Evaluating {len(candidates_data)} candidates with early stopping...")
+
+    def get_avg_score(scores):
+        return sum(scores.values()) / len(scores) if scores else 0.0
+
+    baseline_avg = get_avg_score(baseline_scores)
+
+    async def _eval_chunk(content, chunk):
+        return await run_full_evaluation(
             prompt_version_id=None, # Not saved yet
             dataset_id=dataset_id,
             prompt_template=content,
-            samples=samples,
+            samples=chunk,
             output_schema=prompt["output_schema"],
             task_type=prompt["task_type"],
-            eval_strategy=evaluation_strategy or "exact_match"
+            eval_strategy=evaluation_strategy or "exact_match",
+            return_details=False  # only aggregate_scores are consumed
         )
-        
+
+    total_samples = len(samples)
+    cand_states = [
+        {"content": content, "rationale": rationale, "sums": {}, "count": 0,
+         "avg": 0.0, "active": True, "stopped_early": False}
+        for content, rationale in candidates_data
+    ]
+
+    for start in range(0, total_samples, EVAL_CHUNK_SIZE):
+        active = [st for st in cand_states if st["active"]]
+        if not active:
+            break
+        chunk = samples[start:start + EVAL_CHUNK_SIZE]
+
+        chunk_results = await asyncio.gather(*[_eval_chunk(st["content"], chunk) for st in active])
+
+        for st, chunk_res in zip(active, chunk_results):
+            for metric, value in chunk_res["aggregate_scores"].items():
+                st["sums"][metric] = st["sums"].get(metric, 0.0) + value * len(chunk)
+            st["count"] += len(chunk)
+            st["avg"] = sum(st["sums"].values()) / (len(st["sums"]) * st["count"])
+
+        # Neither stop rule applies after the final chunk: a candidate
+        # that evaluated every sample finished, it didn't stop early
+        if start + EVAL_CHUNK_SIZE >= total_samples:
+            break
+
+        # Lazy pruning: even a perfect score on the remaining samples
+        # can't lift this candidate past the promotion threshold
+        for st in active:
+            remaining = total_samples - st["count"]
+            upper_bound = (st["avg"] * st["count"] + remaining) / total_samples
+            if upper_bound < baseline_avg + PRUNE_MARGIN:
+                st["active"] = False
+                st["stopped_early"] = True
+
+        # Top-m average gap: leader is far enough ahead that the
+        # trailing candidates can't realistically catch up
+        racing = sorted((st for st in cand_states if st["active"]), key=lambda s: s["avg"], reverse=True)
+        if len(racing) >= 2:
+            trailing_avg = sum(st["avg"] for st in racing[1:]) / len(racing[1:])
+            if racing[0]["avg"] - trailing_avg > EARLY_STOP_TAU:
+                for st in racing[1:]:
+                    st["active"] = False
+                    st["stopped_early"] = True
+
+    candidate_results = []
+    cand_rows = []
+
+    for st in cand_states:
+        content = st["content"]
+        rationale = st["rationale"]
+        # Scores for stopped candidates are partial averages over the
+        # samples they saw before being dropped
+        scores = {metric: total / st["count"] for metric, total in st["sums"].items()} if st["count"] else {}
         candidate_data = {
             "content": content,
             "rationale": rationale,
-            "scores": eval_results["aggregate_scores"],
-            "per_example_results": eval_results.get("per_example_results", [])
+            "scores": scores,
+            "samples_evaluated": st["count"],
+            "stopped_early": st["stopped_early"],
+            "per_example_results": []
         }
         candidate_results.append(candidate_data)
-        
-        # Store candidate in database immediately
-        cand_db = {
+
+        cand_rows.append({
             "prompt_id": prompt_id,
             "parent_version_id": base_version["id"],
             "content": content,
             "generation_method": method,
             "rationale": rationale,
             "status": "pending",
-            "evaluation_scores": eval_results["aggregate_scores"]
-        }
-        cand_resp = supabase.table("candidates").insert(cand_db).execute()
+            "evaluation_scores": scores
+        })
+
+    # Store all candidates in one bulk insert (one round-trip instead of
+    # one per candidate). PostgREST returns rows in insert order, so ids
+    # map back to candidate_results by position.
+    stored_candidates = []
+    if cand_rows:
+        cand_resp = await _db(lambda: supabase.table("candidates").insert(cand_rows).execute())
         if cand_resp.data:
-            candidate_data["candidate_id"] = cand_resp.data[0]["id"]
-            stored_candidates.append(cand_resp.data[0])
-        
-    # 8. Compare and find the best candidate
+            stored_candidates = cand_resp.data
+            for candidate_data, stored in zip(candidate_results, stored_candidates):
+                candidate_data["candidate_id"] = stored["id"]
+
+
+    # 8. Compare and find the best candidate: one vectorized argmax over
+    # the per-candidate averages instead of the hand-rolled scan (whose
+    # -1.0 sentinel also mislabeled "no candidate" as an improvement).
+    # Early-stopped candidates are excluded: their averages cover as
+    # few as one chunk and can't be compared against the full-dataset
+    # baseline, let alone promoted - they were behind or hopeless when
+    # dropped. Only candidates that finished the whole dataset compete.
     best_candidate = None
-    best_improvement = -1.0 # Initialize with a low value
-    
-    # Simple aggregate improvement metric: average of all scores
-    def get_avg_score(scores):
-        return sum(scores.values()) / len(scores) if scores else 0.0
+    best_improvement = 0.0
+
+    eligible = [candidate for candidate in candidate_results if not candidate.get("stopped_early")]
+    if eligible:
+        avgs = np.fromiter(
+            (get_avg_score(candidate["scores"]) for candidate in eligible),
+            dtype=np.float64,
+            count=len(eligible)
+        )
+        best_idx = int(avgs.argmax())
+        best_candidate = eligible[best_idx]
+        best_improvement = float(avgs[best_idx]) - baseline_avg
+
 
-    baseline_avg = get_avg_score(baseline_scores)
-    
-    for candidate in candidate_results:
-        cand_avg = get_avg_score(candidate["scores"])
-        improvement = cand_avg - baseline_avg
-        
-        if improvement > best_improvement:
-            best_improvement = improvement
-            best_candidate = candidate
-            
     # 9. Check PRD Promotion Guardrails
     should_promote = False
     rejection_reason = ""
@@ -226,17 +423,25 @@ async def run_improvement_loop(
         else:
             should_promote = True
             
-    # 10. Generate explanation for best candidate
+    # 10. Generate explanation for best candidate. Guardrail rejections
+    # are deterministic and numeric, so they get a templated summary;
+    # only promotions are worth an LLM call
     explanation = ""
     if best_candidate:
-        explanation = await generate_promotion_explanation(
-            baseline_scores=baseline_scores,
-            candidate_scores=best_candidate["scores"],
-            candidate_content=best_candidate["content"],
-            baseline_content=base_version["content"],
-            should_promote=should_promote,
-            rejection_reason=rejection_reason
-        )
+        if should_promote:
+            explanation = await generate_promotion_explanation(
+                baseline_scores=baseline_scores,
+                candidate_scores=best_candidate["scores"],
+                candidate_content=best_candidate["content"],
+                baseline_content=base_version["content"],
+                should_promote=should_promote,
+                rejection_reason=rejection_reason
+            )
+        else:
+            explanation = _format_rejection_explanation(
+                rejection_reason,
+                _metric_deltas(baseline_scores, best_candidate["scores"])
+            )
     
     # 11. Log results and handle promotion
     result = {
@@ -251,51 +456,40 @@ async def run_improvement_loop(
     }
     
     if should_promote and best_candidate:
-        # Update the best candidate's status
         best_candidate_id = best_candidate.get("candidate_id")
-        if best_candidate_id:
-            supabase.table("candidates").update({
-                "status": "promoted" if auto_promote else "accepted"
-            }).eq("id", best_candidate_id).execute()
-        
+
         if auto_promote:
-            # Create new version
-            new_v_resp = supabase.table("prompt_versions").insert({
-                "prompt_id": prompt_id,
-                "version": base_version["version"] + 1,
-                "content": best_candidate["content"],
-                "parent_version_id": base_version["id"],
-                "generation_method": method,
-                "rationale": best_candidate["rationale"],
-                "is_active": True
-            }).execute()
-            
-            if new_v_resp.data:
-                # Deactivate old version
-                # If we're promoting, we should deactivate the PREVIOUS ACTIVE version, 
-                # but which one is that? Let's just deactivate all for this prompt to be safe.
-                supabase.table("prompt_versions").update({"is_active": False}).eq("prompt_id", prompt_id).execute()
-                
-                # Activate new version
-                supabase.table("prompt_versions").update({"is_active": True}).eq("id", new_v_resp.data[0]["id"]).execute()
-
-                # Log promotion history with explanation
-                supabase.table("promotion_history").insert({
-                    "prompt_id": prompt_id,
-                    "from_version_id": base_version["id"],
-                    "to_version_id": new_v_resp.data[0]["id"],
-                    "reason": explanation or f"Auto-promoted: {best_candidate['rationale']}",
-                    "metric_deltas": {k: best_candidate["scores"][k] - baseline_scores[k] for k in baseline_scores},
-                    "promoted_by": "system"
-                }).execute()
-                
-                result["promoted_version_id"] = new_v_resp.data[0]["id"]
+            # Run the whole promotion through a single transactional RPC:
+            # candidate status, version insert, active-flag flip and the
+            # promotion_history row all commit (or roll back) together,
+            # in one round-trip instead of five.
+            rpc_params = {
+                "p_candidate_id": best_candidate_id,
+                "p_prompt_id": prompt_id,
+                "p_parent_version_id": base_version["id"],
+                "p_content": best_candidate["content"],
+                "p_method": method,
+                "p_rationale": best_candidate["rationale"],
+                "p_reason": explanation or f"Auto-promoted: {best_candidate['rationale']}",
+                "p_metric_deltas": _metric_deltas(baseline_scores, best_candidate["scores"])
+            }
+            rpc_resp = await _db(lambda: supabase.rpc("promote_candidate", rpc_params).execute())
+
+            if rpc_resp.data:
+                result["promoted_version_id"] = rpc_resp.data["new_version_id"]
+        elif best_candidate_id:
+            # Status bookkeeping; nothing downstream reads it this run
+            _fire_and_forget(lambda: supabase.table("candidates").update({
+                "status": "accepted"
+            }).eq("id", best_candidate_id).execute())
     else:
-        # Mark rejected candidates
-        for cand in stored_candidates:
-            if cand["id"] != best_candidate.get("candidate_id"):
-                supabase.table("candidates").update({
-                    "status": "rejected"
-                }).eq("id", cand["id"]).execute()
-                
+        # Mark rejected candidates in one round-trip
+        best_candidate_id = best_candidate.get("candidate_id") if best_candidate else None
+        reject_ids = [cand["id"] for cand in stored_candidates if cand["id"] != best_candidate_id]
+        if reject_ids:
+            # Status bookkeeping; nothing downstream reads it this run
+            _fire_and_forget(lambda: supabase.table("candidates").update({
+                "status": "rejected"
+            }).in_("id", reject_ids).execute())
+
     return result
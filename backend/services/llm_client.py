@@ -1,8 +1,12 @@
 import os
+import hashlib
+import json
 import logging
+import random
 import asyncio
 from pathlib import Path
 import httpx
+from cachetools import TTLCache
 from typing import Dict, Any, Optional
 
 from dotenv import load_dotenv
@@ -19,11 +23,115 @@ OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 # Default model - use a valid free model
 DEFAULT_MODEL = "xiaomi/mimo-v2-flash:free"
 
+# Request headers are invariant per process; building them per call
+# also re-ran the FRONTEND_URL env lookup on every invocation
+_BASE_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "HTTP-Referer": os.getenv("FRONTEND_URL", "https://prompt-optimization.local"),
+    "X-Title": "Prompt Optimization Platform",
+    "Content-Type": "application/json"
+}
+
 # Retry configuration
 MAX_RETRIES = 3
 INITIAL_BACKOFF = 5.0  # seconds
 MAX_BACKOFF = 30.0  # seconds
 
+# Global cap on in-flight LLM requests. Evaluation fans out several LLM
+# calls per sample via asyncio.gather, so without a bound a single run
+# can put hundreds of requests in flight and trip provider rate limits.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+# Shared HTTP client, created lazily on first call. Reusing one client
+# pools connections to OpenRouter, so repeated calls skip the TCP+TLS
+# handshake that a fresh AsyncClient pays per request.
+_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared AsyncClient, creating it on first use"""
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = httpx.AsyncClient(
+            base_url=OPENROUTER_BASE_URL,
+            timeout=120.0,  # Increased timeout for longer responses
+            limits=httpx.Limits(max_connections=128, max_keepalive_connections=64)
+        )
+    return _CLIENT
+
+
+async def close_client() -> None:
+    """Close the shared AsyncClient; wired to FastAPI shutdown"""
+    global _CLIENT
+    if _CLIENT is not None and not _CLIENT.is_closed:
+        await _CLIENT.aclose()
+    _CLIENT = None
+
+
+# Response cache for deterministic calls. Judges, explanations and
+# evaluation generations all run at temperature 0, and the improvement
+# loop repeats identical requests across baseline + candidates; a hit
+# returns in microseconds instead of a full API round-trip. Calls above
+# the threshold are intentionally non-deterministic and never cached.
+_LLM_CACHE_TEMP_THRESHOLD = 0.1
+_LLM_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+_LLM_CACHE_LOCK = asyncio.Lock()
+
+
+def _cache_key(
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    messages: list[Dict[str, str]],
+    response_format: Optional[Dict[str, str]],
+    n: int = 1
+) -> str:
+    """Content hash over everything that affects the response"""
+    blob = json.dumps(
+        {"m": model, "t": temperature, "mt": max_tokens, "msgs": messages, "rf": response_format, "n": n},
+        sort_keys=True
+    )
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+async def _post_streaming(
+    client: httpx.AsyncClient,
+    headers: Dict[str, str],
+    payload: Dict[str, Any]
+) -> tuple:
+    """POST with SSE streaming and accumulate the delta content.
+
+    Tokens are consumed as they arrive instead of waiting for the
+    provider to buffer and flush the full body. Returns
+    (status_code, content, error_body, retry_after_header).
+    """
+    chunks: list[str] = []
+    async with client.stream(
+        "POST", "/chat/completions", headers=headers, json={**payload, "stream": True}
+    ) as response:
+        retry_after_header = response.headers.get("Retry-After")
+        if response.status_code != 200:
+            error_body = (await response.aread()).decode("utf-8", errors="replace")
+            return response.status_code, "", error_body, retry_after_header
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue  # SSE comments / keep-alives
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            try:
+                frame = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            delta = frame.get("choices", [{}])[0].get("delta", {})
+            piece = delta.get("content")
+            if piece:
+                chunks.append(piece)
+
+        return response.status_code, "".join(chunks), "", retry_after_header
+
 
 class LLMError(Exception):
     """Custom exception for LLM-related errors"""
@@ -39,7 +147,10 @@ async def call_llm(
     temperature: float = 0.7,
     max_tokens: Optional[int] = None,
     response_format: Optional[Dict[str, str]] = None,
-    retry_count: int = MAX_RETRIES
+    retry_count: int = MAX_RETRIES,
+    stream: bool = False,
+    n: int = 1,
+    use_cache: bool = True
 ) -> str:
     """
     Call OpenRouter API with retry logic and error handling.
@@ -51,6 +162,12 @@ async def call_llm(
         max_tokens: Maximum tokens in response
         response_format: Optional format hint (e.g., {"type": "json_object"})
         retry_count: Number of retries on failure
+        stream: Consume the response as SSE tokens instead of one buffered
+            body; the full content string is still returned
+        n: Number of completions to request; only the first is returned
+            here, use call_llm_n to get all of them
+        use_cache: Set False to bypass the deterministic-response cache,
+            e.g. when re-sampling the same prompt to measure consistency
         
     Returns:
         The content string from the LLM response
@@ -60,15 +177,16 @@ async def call_llm(
     """
     if not OPENROUTER_API_KEY:
         raise LLMError("OPENROUTER_API_KEY environment variable must be set")
-    
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "HTTP-Referer": os.getenv("FRONTEND_URL", "https://prompt-optimization.local"),
 
-        "X-Title": "Prompt Optimization Platform",
-        "Content-Type": "application/json"
-    }
-    
+    cache_key = None
+    if use_cache and temperature <= _LLM_CACHE_TEMP_THRESHOLD:
+        cache_key = _cache_key(model, temperature, max_tokens, messages, response_format, n)
+        async with _LLM_CACHE_LOCK:
+            cached = _LLM_CACHE.get(cache_key)
+        if cached is not None:
+            logger.debug("LLM cache hit, skipping API call")
+            return cached
+
     payload: Dict[str, Any] = {
         "model": model,
         "messages": messages,
@@ -80,80 +198,106 @@ async def call_llm(
         
     if response_format:
         payload["response_format"] = response_format
-    
+
+    if n > 1:
+        payload["n"] = n
+
     last_error: Optional[Exception] = None
     backoff = INITIAL_BACKOFF
     
-    for attempt in range(retry_count):
-        try:
-            logger.debug(f"LLM call attempt {attempt + 1}/{retry_count} to model {model}")
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{OPENROUTER_BASE_URL}/chat/completions",
-                    headers=headers,
-                    json=payload,
-                    timeout=120.0  # Increased timeout for longer responses
-                )
-                
+    async with LLM_SEMAPHORE:
+        for attempt in range(retry_count):
+            try:
+                logger.debug(f"LLM call attempt {attempt + 1}/{retry_count} to model {model}")
+
+                client = _get_client()
+
+                if stream:
+                    status_code, content, error_body, retry_after_header = await _post_streaming(
+                        client, _BASE_HEADERS, payload
+                    )
+                else:
+                    response = await client.post(
+                        "/chat/completions",
+                        headers=_BASE_HEADERS,
+                        json=payload
+                    )
+                    status_code = response.status_code
+                    retry_after_header = response.headers.get("Retry-After")
+                    content = ""
+                    error_body = ""
+                    if status_code == 200:
+                        result = response.json()
+                        content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+                    elif status_code != 429 and status_code < 500:
+                        error_body = response.text
+
                 # Log response status
-                logger.debug(f"LLM response status: {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-                    
+                logger.debug(f"LLM response status: {status_code}")
+
+                if status_code == 200:
                     if not content:
                         logger.warning("LLM returned empty content")
                         raise LLMError("LLM returned empty content", status_code=200)
-                    
+
                     logger.debug(f"LLM call successful, response length: {len(content)}")
+                    if cache_key is not None:
+                        async with _LLM_CACHE_LOCK:
+                            _LLM_CACHE[cache_key] = content
                     return content
-                    
-                elif response.status_code == 429:
-                    # Rate limited - wait and retry
-                    logger.warning(f"Rate limited (429), waiting {backoff}s before retry")
-                    await asyncio.sleep(backoff)
-                    backoff = min(backoff * 2, MAX_BACKOFF)
+
+                elif status_code == 429:
+                    # Rate limited - honor the server's Retry-After when
+                    # present instead of guessing, with jitter so
+                    # concurrent evals don't all retry in lockstep
+                    try:
+                        retry_after = float(retry_after_header) if retry_after_header else backoff
+                    except ValueError:
+                        retry_after = backoff
+                    wait = min(max(retry_after, 0.1), MAX_BACKOFF) * random.uniform(0.8, 1.2)
+                    logger.warning(f"Rate limited (429), waiting {wait:.1f}s before retry")
+                    await asyncio.sleep(wait)
+                    if not retry_after_header:
+                        # Only escalate when the server gave no hint
+                        backoff = min(backoff * 2, MAX_BACKOFF)
                     continue
-                    
-                elif response.status_code >= 500:
+
+                elif status_code >= 500:
                     # Server error - retry
-                    logger.warning(f"Server error ({response.status_code}), waiting {backoff}s before retry")
+                    logger.warning(f"Server error ({status_code}), waiting {backoff}s before retry")
                     await asyncio.sleep(backoff)
                     backoff = min(backoff * 2, MAX_BACKOFF)
                     continue
-                    
+
                 else:
                     # Client error (4xx) - don't retry, raise immediately
-                    error_body = response.text
-                    logger.error(f"LLM API error: {response.status_code} - {error_body}")
+                    logger.error(f"LLM API error: {status_code} - {error_body}")
                     raise LLMError(
-                        f"LLM API error: {response.status_code}",
-                        status_code=response.status_code,
+                        f"LLM API error: {status_code}",
+                        status_code=status_code,
                         response_body=error_body
                     )
                     
-        except httpx.TimeoutException as e:
-            logger.warning(f"LLM call timed out on attempt {attempt + 1}")
-            last_error = e
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, MAX_BACKOFF)
+            except httpx.TimeoutException as e:
+                logger.warning(f"LLM call timed out on attempt {attempt + 1}")
+                last_error = e
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
             
-        except httpx.RequestError as e:
-            logger.warning(f"LLM request error on attempt {attempt + 1}: {str(e)}")
-            last_error = e
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, MAX_BACKOFF)
+            except httpx.RequestError as e:
+                logger.warning(f"LLM request error on attempt {attempt + 1}: {str(e)}")
+                last_error = e
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
             
-        except LLMError:
-            raise
+            except LLMError:
+                raise
             
-        except Exception as e:
-            logger.error(f"Unexpected error in LLM call: {str(e)}")
-            last_error = e
-            break
-    
+            except Exception as e:
+                logger.error(f"Unexpected error in LLM call: {str(e)}")
+                last_error = e
+                break
+
     # All retries exhausted
     error_msg = f"LLM call failed after {retry_count} attempts"
     if last_error:
@@ -204,3 +348,73 @@ async def call_llm_with_fallback(
             continue
     
     raise LLMError(f"All models failed. Last error: {str(last_error)}")
+
+
+async def call_llm_n(
+    messages: list[Dict[str, str]],
+    model: str = DEFAULT_MODEL,
+    temperature: float = 0.7,
+    max_tokens: Optional[int] = None,
+    response_format: Optional[Dict[str, str]] = None,
+    n: int = 1,
+    use_cache: bool = True
+) -> list[str]:
+    """
+    Request n completions of the same prompt.
+
+    Tries a single API call with the OpenAI-compatible n parameter so the
+    prompt is billed and transmitted once; providers that ignore n (or a
+    failed request) fall back to n concurrent single-completion calls.
+
+    Args:
+        messages: List of message dicts with 'role' and 'content'
+        model: Model identifier
+        temperature: Sampling temperature (0.0-2.0)
+        max_tokens: Maximum tokens per completion
+        response_format: Optional format hint
+        n: Number of completions wanted
+        use_cache: Forwarded to call_llm in the fallback path; must be
+            False when the n samples need to be independent draws
+
+    Returns:
+        List of n content strings
+    """
+    if n <= 1:
+        return [await call_llm(messages, model, temperature, max_tokens, response_format, use_cache=use_cache)]
+
+    payload: Dict[str, Any] = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "n": n
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    if response_format:
+        payload["response_format"] = response_format
+
+    try:
+        async with LLM_SEMAPHORE:
+            client = _get_client()
+            response = await client.post("/chat/completions", headers=_BASE_HEADERS, json=payload)
+
+        if response.status_code == 200:
+            result = response.json()
+            contents = [
+                choice.get("message", {}).get("content", "")
+                for choice in result.get("choices", [])
+            ]
+            contents = [content for content in contents if content]
+            if len(contents) >= n:
+                return contents[:n]
+            logger.warning(f"Provider returned {len(contents)}/{n} completions, falling back to parallel calls")
+        else:
+            logger.warning(f"n-completion request failed ({response.status_code}), falling back to parallel calls")
+    except httpx.HTTPError as e:
+        logger.warning(f"n-completion request error, falling back to parallel calls: {str(e)}")
+
+    results = await asyncio.gather(*[
+        call_llm(messages, model, temperature, max_tokens, response_format, use_cache=use_cache)
+        for _ in range(n)
+    ])
+    return list(results)
@@ -1,72 +1,83 @@
 """
 Utility functions for prompt processing and variable detection
 """
+import functools
 import re
-from typing import List, Set
+from typing import Iterable, List, Tuple
+
+# Matches {variable_name} where variable_name is a valid Python identifier
+_VAR_RE = re.compile(r'\{([a-zA-Z_][a-zA-Z0-9_]*)\}')
+
+
+@functools.lru_cache(maxsize=2048)
+def _extract_variables_cached(prompt_content: str) -> Tuple[str, ...]:
+    """Scan a prompt for placeholders, memoized per prompt string.
+
+    The same prompt content is re-scanned across candidate evaluations,
+    so cache the result; dict.fromkeys dedupes while preserving order
+    of first appearance.
+    """
+    return tuple(dict.fromkeys(m.group(1) for m in _VAR_RE.finditer(prompt_content)))
 
 
 def extract_variables(prompt_content: str) -> List[str]:
     """
     Extract variable names from prompt content.
-    
+
     Variables are defined as {variable_name} where variable_name follows
     Python identifier rules (starts with letter or underscore, contains
     alphanumeric characters and underscores).
-    
+
     Args:
         prompt_content: The prompt text to analyze
-        
+
     Returns:
         List of unique variable names in order of first appearance
     """
     if not prompt_content:
         return []
-    
-    # Pattern matches {variable_name} where variable_name is a valid Python identifier
-    pattern = r'\{([a-zA-Z_][a-zA-Z0-9_]*)\}'
-    
-    # Find all matches and preserve order while removing duplicates
-    seen: Set[str] = set()
-    variables: List[str] = []
-    
-    for match in re.finditer(pattern, prompt_content):
-        var_name = match.group(1)
-        if var_name not in seen:
-            seen.add(var_name)
-            variables.append(var_name)
-    
-    return variables
+
+    return list(_extract_variables_cached(prompt_content))
 
 
 def validate_variable_mapping(
-    prompt_variables: List[str],
-    dataset_columns: List[str],
+    prompt_variables: Iterable[str],
+    dataset_columns: Iterable[str],
     variable_mapping: dict
 ) -> tuple[bool, str]:
     """
     Validate that a variable mapping is complete and correct.
-    
+
+    Callers validating many candidates against the same prompt/dataset
+    should pass prompt_variables and dataset_columns as frozensets so
+    the pre-hashed sets are reused instead of rebuilt per call.
+
     Args:
-        prompt_variables: List of variables in the prompt
-        dataset_columns: List of columns in the dataset
+        prompt_variables: Variables in the prompt
+        dataset_columns: Columns in the dataset
         variable_mapping: Mapping from prompt variables to dataset columns
-        
+
     Returns:
         Tuple of (is_valid, error_message)
     """
     if not prompt_variables:
         return True, ""
-    
+
+    if not isinstance(prompt_variables, (set, frozenset)):
+        prompt_variables = frozenset(prompt_variables)
+    if not isinstance(dataset_columns, (set, frozenset)):
+        dataset_columns = frozenset(dataset_columns)
+
     # Check all prompt variables are mapped
-    unmapped = set(prompt_variables) - set(variable_mapping.keys())
+    unmapped = prompt_variables.difference(variable_mapping.keys())
     if unmapped:
         return False, f"Unmapped variables: {', '.join(unmapped)}"
-    
+
     # Check all mapped columns exist in dataset
-    invalid_columns = set(variable_mapping.values()) - set(dataset_columns)
+    invalid_columns = frozenset(variable_mapping.values()).difference(dataset_columns)
     if invalid_columns:
         return False, f"Invalid dataset columns: {', '.join(invalid_columns)}"
-    
+
     return True, ""
 
 
@@ -81,11 +92,10 @@ def substitute_variables(prompt_template: str, variables: dict) -> str:
     Returns:
         Prompt with all variables substituted
     """
-    result = prompt_template
-    for key, value in variables.items():
-        placeholder = f"{{{key}}}"
-        if placeholder in result:
-            result = result.replace(placeholder, str(value))
-    
-    return result
+    # Single left-to-right pass; chained str.replace rescanned the whole
+    # (growing) result once per variable. Unknown placeholders are kept.
+    return _VAR_RE.sub(
+        lambda m: str(variables[m.group(1)]) if m.group(1) in variables else m.group(0),
+        prompt_template
+    )
 
@@ -0,0 +1,15 @@
+-- Bulk insert helper for dataset samples.
+-- Clients previously repeated the dataset_id UUID on every row of a batch
+-- insert; this function takes it once and fans it out server-side.
+CREATE OR REPLACE FUNCTION insert_samples(p_dataset_id UUID, p_samples JSONB)
+RETURNS void AS $$
+BEGIN
+    INSERT INTO dataset_samples (dataset_id, input, expected_output, metadata)
+    SELECT
+        p_dataset_id,
+        s->'input',
+        s->'expected_output',
+        COALESCE(s->'metadata', '{}'::jsonb)
+    FROM jsonb_array_elements(p_samples) AS s;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,44 @@
+-- Atomic promotion of a candidate to a new active prompt version.
+-- The improvement loop previously issued five sequential writes
+-- (candidate status, version insert, deactivate, activate, history);
+-- this bundles them into one round-trip and one transaction, so a
+-- crash mid-promotion can no longer leave a prompt with zero or two
+-- active versions.
+-- The original status check from init.sql didn't allow 'promoted',
+-- which the promotion path writes; without this the whole RPC
+-- transaction aborts on the first UPDATE.
+ALTER TABLE candidates DROP CONSTRAINT IF EXISTS candidates_status_check;
+ALTER TABLE candidates ADD CONSTRAINT candidates_status_check
+    CHECK (status IN ('pending', 'evaluating', 'accepted', 'rejected', 'promoted'));
+
+CREATE OR REPLACE FUNCTION promote_candidate(
+    p_candidate_id UUID,
+    p_prompt_id UUID,
+    p_parent_version_id UUID,
+    p_content TEXT,
+    p_method TEXT,
+    p_rationale TEXT,
+    p_reason TEXT,
+    p_metric_deltas JSONB
+)
+RETURNS JSON AS $$
+DECLARE
+    new_version_id UUID;
+    parent_version INT;
+BEGIN
+    UPDATE candidates SET status = 'promoted' WHERE id = p_candidate_id;
+
+    SELECT version INTO parent_version FROM prompt_versions WHERE id = p_parent_version_id;
+
+    UPDATE prompt_versions SET is_active = false WHERE prompt_id = p_prompt_id;
+
+    INSERT INTO prompt_versions (prompt_id, version, content, parent_version_id, generation_method, rationale, is_active)
+    VALUES (p_prompt_id, parent_version + 1, p_content, p_parent_version_id, p_method, p_rationale, true)
+    RETURNING id INTO new_version_id;
+
+    INSERT INTO promotion_history (prompt_id, from_version_id, to_version_id, reason, metric_deltas, promoted_by)
+    VALUES (p_prompt_id, p_parent_version_id, new_version_id, p_reason, p_metric_deltas, 'system');
+
+    RETURN json_build_object('new_version_id', new_version_id);
+END;
+$$ LANGUAGE plpgsql;